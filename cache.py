@@ -0,0 +1,59 @@
+"""
+cache.py
+
+In-process caches plus the optional Redis client.
+
+The Redis client is only created when REDIS_URL is set; callers must treat
+get_redis() returning None as "no cache" and fall back to Postgres.
+"""
+
+import logging
+
+from cachetools import TTLCache
+
+from config import settings
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis is optional
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+_redis = None
+
+# code -> (id, is_active, redirect_url) for the /r/{code} hot path.
+# Entries are dropped on admin edits in this process; other workers pick the
+# change up when the TTL expires.
+qr_code_cache: TTLCache = TTLCache(maxsize=5000, ttl=60)
+
+# Codes that do not exist, so repeated probes of /r/<random> skip the DB.
+qr_code_miss_cache: TTLCache = TTLCache(maxsize=10000, ttl=30)
+
+
+def invalidate_qr_code(code: str):
+    qr_code_cache.pop(code, None)
+    qr_code_miss_cache.pop(code, None)
+
+
+def init_redis():
+    """Create the shared client at startup (connections are opened lazily)."""
+    global _redis
+    if not settings.REDIS_URL:
+        return
+    if aioredis is None:
+        logger.warning("REDIS_URL is set but the redis package is not installed")
+        return
+    _redis = aioredis.from_url(settings.REDIS_URL, decode_responses=True)
+    logger.info("Redis cache enabled")
+
+
+def get_redis():
+    return _redis
+
+
+async def close_redis():
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
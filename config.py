@@ -15,6 +15,7 @@ class Settings(BaseSettings):
     DB_MAX_OVERFLOW: int = 10  # Additional connections when pool is full
     DB_POOL_RECYCLE: int = 3600  # Recycle connections after 1 hour
     DB_POOL_PRE_PING: bool = True  # Test connections before using
+    DB_STATEMENT_CACHE_SIZE: int = 256  # Prepared statements kept per connection (0 behind a pooler without prepared-statement support)
     
     # JWT
     SECRET_KEY: str = "your-secret-key-change-in-production"
@@ -28,9 +29,9 @@ class Settings(BaseSettings):
     # Logging
     LOG_LEVEL: str = "INFO"  # DEBUG, INFO, WARNING, ERROR
     
-    # # Redis Cache (Optional - add when implementing caching)
-    # REDIS_URL: Optional[str] = None  # "redis://localhost:6379"
-    # CACHE_TTL: int = 300  # 5 minutes default cache
+    # Redis Cache (Optional - skips the session_first_seen write for known sessions)
+    REDIS_URL: Optional[str] = None  # "redis://localhost:6379"
+    SESSION_CACHE_TTL: int = 60 * 60 * 24 * 30  # Remember seen sessions for 30 days
     
     # # Rate Limiting
     # RATE_LIMIT_ENABLED: bool = True
@@ -42,6 +43,10 @@ class Settings(BaseSettings):
     # Background Tasks
     ENABLE_BACKGROUND_TASKS: bool = True
     LOCATION_LOOKUP_ASYNC: bool = True  # Lookup location in background
+    LOCATION_ENRICH_WORKERS: int = 4  # Workers draining the location queue
+    LOCATION_ENRICH_BATCH_SIZE: int = 50  # Max rows updated per batch
+    GEOIP_DB_PATH: Optional[str] = None  # GeoLite2-City.mmdb; enables in-request location lookup
+    ANALYTICS_REFRESH_INTERVAL: int = 300  # Seconds between materialized view refreshes
     
     class Config:
         env_file = ".env"
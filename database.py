@@ -26,7 +26,11 @@ engine = create_async_engine(
     connect_args={
         "server_settings": {
             "application_name": "social_media",  # Identify connections in PostgreSQL
-        }
+        },
+        # Per-connection prepared statement cache size (SQLAlchemy's asyncpg
+        # adapter and asyncpg itself); the adapter's default is 100
+        "prepared_statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+        "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
     }
 )
 
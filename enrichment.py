@@ -0,0 +1,144 @@
+"""
+enrichment.py
+
+Background IP -> location enrichment for qr_scans and social_clicks.
+
+With a local MaxMind database loaded (GEOIP_DB_PATH), handlers resolve the
+location inline via local_location_values() and nothing is queued. Otherwise
+they only enqueue (model, row_id, ip) for the HTTP lookup. A small fixed pool of
+workers drains the queue in batches, looks each distinct IP up once and
+writes the results back with one UPDATE ... WHERE id = ANY(:row_ids)
+statement per table, executed once with a parameter set per IP, so a burst
+of scans costs O(workers) pooled connections, O(unique IPs) lookups and a
+single pipelined executemany per table instead of one session, lookup and
+UPDATE per scan.
+"""
+
+import asyncio
+import logging
+from collections import defaultdict
+
+from sqlalchemy import update, bindparam, any_, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from database import async_session_maker
+from models import QRScan, SocialClick
+from utils import get_cached_location_from_ip, get_location_from_local_db
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Location columns filled in per table
+LOCATION_COLUMNS = {
+    QRScan: ("country", "city", "region"),
+    SocialClick: ("country", "city"),
+}
+
+BATCH_WINDOW = 0.2  # Seconds to wait for a batch to fill up
+SHUTDOWN_DRAIN_TIMEOUT = 5.0  # Seconds to finish queued rows on shutdown
+
+_queue: asyncio.Queue = asyncio.Queue(maxsize=10000)
+_workers: list = []
+
+
+def local_location_values(model, ip_address: str) -> dict:
+    """
+    Location columns for a row about to be inserted, resolved in-process from
+    the local MaxMind database. Empty when no database is loaded (or no IP) —
+    the row is then enqueued for background enrichment instead.
+    """
+    if not ip_address:
+        return {}
+    location_data = get_location_from_local_db(ip_address)
+    if location_data is None:
+        return {}
+    return {col: location_data.get(col) for col in LOCATION_COLUMNS[model]}
+
+
+def enqueue_location(model, row_id: int, ip_address: str):
+    """Schedule a location lookup for a freshly inserted row. Never blocks."""
+    try:
+        _queue.put_nowait((model, row_id, ip_address))
+    except asyncio.QueueFull:
+        logger.warning(f"Enrichment queue full, skipping {model.__tablename__} #{row_id}")
+
+
+async def _next_batch() -> list:
+    """Wait for one item, then collect more for up to BATCH_WINDOW seconds."""
+    loop = asyncio.get_running_loop()
+    batch = [await _queue.get()]
+    deadline = loop.time() + BATCH_WINDOW
+
+    while len(batch) < settings.LOCATION_ENRICH_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+
+    return batch
+
+
+async def _enrich_batch(batch: list):
+    # Scans arrive in bursts from shared IPs (office NAT, one phone):
+    # one lookup and one parameter set per IP, not per row.
+    ids_by_ip = defaultdict(lambda: defaultdict(list))
+    for model, row_id, ip_address in batch:
+        ids_by_ip[ip_address][model].append(row_id)
+
+    ips = list(ids_by_ip)
+    locations = await asyncio.gather(*(get_cached_location_from_ip(ip) for ip in ips))
+
+    params_by_model = defaultdict(list)
+    for ip_address, location_data in zip(ips, locations):
+        for model, row_ids in ids_by_ip[ip_address].items():
+            params = {f"new_{col}": location_data.get(col) for col in LOCATION_COLUMNS[model]}
+            params["row_ids"] = row_ids
+            params_by_model[model].append(params)
+
+    async with async_session_maker() as db:
+        for model, params in params_by_model.items():
+            table = model.__table__
+            # id = ANY(array) keeps the SQL identical whatever the id count,
+            # so asyncpg reuses one prepared statement for the executemany
+            stmt = (
+                update(table)
+                .where(table.c.id == any_(bindparam("row_ids", type_=ARRAY(Integer))))
+                .values({col: bindparam(f"new_{col}") for col in LOCATION_COLUMNS[model]})
+            )
+            await db.execute(stmt, params)
+        await db.commit()
+
+    logger.info(f"📍 Location enriched for {len(batch)} rows from {len(ips)} IPs")
+
+
+async def _worker():
+    while True:
+        batch = await _next_batch()
+        try:
+            await _enrich_batch(batch)
+        except Exception as e:
+            logger.error(f"Location enrich failed for batch of {len(batch)}: {e}")
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+
+def start_enrichment_workers():
+    for _ in range(settings.LOCATION_ENRICH_WORKERS):
+        _workers.append(asyncio.create_task(_worker()))
+
+
+async def stop_enrichment_workers():
+    """Give queued rows a bounded chance to be enriched, then stop the workers."""
+    try:
+        await asyncio.wait_for(_queue.join(), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Shutting down with {_queue.qsize()} rows still waiting for location")
+
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -1,8 +1,10 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 import time
 
@@ -15,6 +17,10 @@ from routes.hierarchy import router as hierarchy_router
 from routes.analytics import router as analytics_router
 
 from database import close_db_connections, check_db_connection
+from cache import init_redis, close_redis
+from enrichment import start_enrichment_workers, stop_enrichment_workers
+from utils import init_geoip, close_geoip
+from materialized_views import ensure_materialized_views, refresh_materialized_views_forever
 from config import settings
 
 # Configure logging
@@ -33,12 +39,26 @@ async def lifespan(app: FastAPI):
     
     if await check_db_connection():
         logger.info("✅ Database connection successful")
+        try:
+            await ensure_materialized_views()
+        except Exception as e:
+            logger.error(f"❌ Materialized view setup failed: {e}")
     else:
         logger.error("❌ Database connection failed")
     
+    init_redis()
+    init_geoip()
+    start_enrichment_workers()
+    refresh_task = asyncio.create_task(refresh_materialized_views_forever())
+    
     yield
     
     logger.info("Shutting down GK QR Manager API")
+    refresh_task.cancel()
+    await asyncio.gather(refresh_task, return_exceptions=True)
+    await stop_enrichment_workers()
+    await close_redis()
+    close_geoip()
     await close_db_connections()
     logger.info("✅ All connections closed gracefully")
 
@@ -95,6 +115,9 @@ app.add_middleware(
     expose_headers=["X-Process-Time"],
 )
 
+# Compress HTML/JSON responses (redirect page, analytics payloads)
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 # Include routers
 app.include_router(auth_router, tags=["Authentication"])
 app.include_router(public_router, tags=["Public"])
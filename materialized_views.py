@@ -0,0 +1,112 @@
+"""
+materialized_views.py
+
+Pre-aggregated views backing the analytics dashboards.
+
+social_click_daily rolls social_clicks up to one row per (branch, day,
+platform), so /api/social-analytics reads O(days x platforms) rows instead of
+counting every click. It is refreshed in the background every
+ANALYTICS_REFRESH_INTERVAL seconds — dashboard numbers may lag live clicks by
+at most that interval.
+"""
+
+import asyncio
+import logging
+
+from sqlalchemy import text, table, column, Integer, BigInteger, String, Date
+
+from database import engine
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Lightweight Core handle for querying the view (it is not an ORM model)
+social_click_daily = table(
+    "social_click_daily",
+    column("branch_id", Integer),
+    column("day", Date),
+    column("platform", String),
+    column("cnt", BigInteger),
+)
+
+# Arbitrary constant: lets only one worker process refresh at a time
+_REFRESH_LOCK_KEY = 7300501
+
+
+async def ensure_materialized_views():
+    """
+    Create the views and their unique indexes if they don't exist yet.
+    The unique index is required for REFRESH ... CONCURRENTLY.
+
+    Views built from an older definition (days bucketed in the server's
+    local time zone instead of UTC) are dropped and rebuilt, since
+    CREATE ... IF NOT EXISTS would keep them as they are.
+    """
+    async with engine.begin() as conn:
+        # Serialise with other workers (and with refreshes) while (re)building
+        await conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"),
+            {"key": _REFRESH_LOCK_KEY}
+        )
+        outdated = (await conn.execute(text("""
+            SELECT 1 FROM pg_matviews
+            WHERE matviewname = 'social_click_daily'
+              AND definition NOT LIKE '%UTC%'
+        """))).scalar()
+        if outdated:
+            logger.info("Rebuilding social_click_daily with UTC day buckets")
+            await conn.execute(text("DROP MATERIALIZED VIEW social_click_daily"))
+
+        await conn.execute(text("""
+            CREATE MATERIALIZED VIEW IF NOT EXISTS social_click_daily AS
+            SELECT
+                branch_id,
+                (clicked_at AT TIME ZONE 'UTC')::date AS day,
+                platform,
+                COUNT(*) AS cnt
+            FROM social_clicks
+            GROUP BY 1, 2, 3
+        """))
+        await conn.execute(text("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_social_click_daily_key
+            ON social_click_daily (branch_id, day, platform)
+        """))
+
+
+async def refresh_social_click_daily() -> bool:
+    """
+    Refresh social_click_daily without blocking readers.
+    Returns False if another worker is already refreshing.
+    """
+    async with engine.begin() as conn:
+        locked = (await conn.execute(
+            text("SELECT pg_try_advisory_xact_lock(:key)"),
+            {"key": _REFRESH_LOCK_KEY}
+        )).scalar()
+        if not locked:
+            return False
+
+        await conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY social_click_daily"))
+        return True
+
+
+async def refresh_materialized_views_forever():
+    """
+    Background loop started from the app lifespan; cancelled on shutdown.
+
+    Keeps retrying ensure_materialized_views() until it succeeds, and again
+    after any failed refresh, so a database that was unreachable at startup
+    (or a view dropped underneath us) recovers without a restart.
+    """
+    views_ready = False
+    while True:
+        await asyncio.sleep(settings.ANALYTICS_REFRESH_INTERVAL)
+        try:
+            if not views_ready:
+                await ensure_materialized_views()
+                views_ready = True
+            if await refresh_social_click_daily():
+                logger.debug("Refreshed social_click_daily")
+        except Exception as e:
+            views_ready = False
+            logger.error(f"Materialized view refresh failed: {e}")
@@ -1,100 +1,116 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, BackgroundTasks
-from fastapi.responses import HTMLResponse
+from fastapi.responses import Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 import logging
-import uuid
+import orjson
+import re
+import string
+from secrets import token_hex
 
 from database import get_db, async_session_maker
 from models import QRCode, QRScan
-from utils import parse_device_info, get_location_from_ip
-from utils_session import is_new_user_atomic
+from utils import parse_device_info
+from utils_session import insert_with_first_seen, remember_session
+from enrichment import enqueue_location, local_location_values
+from cache import qr_code_cache, qr_code_miss_cache
 from config import settings
 
 router = APIRouter(tags=["Public"])
 logger = logging.getLogger(__name__)
 
 
-async def _enrich_location(scan_id: int, ip_address: str):
-    """
-    Runs after the response is already sent.
-    Looks up city/country from IP and updates the scan row.
-    Uses its own DB session — never touches the request session.
-    """
-    async with async_session_maker() as db:
-        try:
-            location_data = await get_location_from_ip(ip_address)
-            if not location_data:
-                return
-
-            result = await db.execute(select(QRScan).where(QRScan.id == scan_id))
-            scan = result.scalar_one_or_none()
-            if scan:
-                scan.country = location_data.get("country")
-                scan.city    = location_data.get("city")
-                scan.region  = location_data.get("region")
-                await db.commit()
-                logger.info(f"📍 Location enriched for scan #{scan_id}: {scan.city}, {scan.country}")
-        except Exception as e:
-            logger.error(f"Location enrich failed for scan #{scan_id}: {e}")
+# Redirect page for /r/{code}. BASE_URL is fixed per process, so it is
+# substituted once at import; the page is then minified (every JS statement
+# ends in ";" or "}" so lines can be joined) and the remaining placeholders
+# split it into pre-encoded chunks — each request only joins bytes.
+_REDIRECT_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>Redirecting...</title>
+</head>
+<body>
+<script>
+const url = "$base_url/api/scan-log";
+const body = new Blob([JSON.stringify({
+    qr_code_id: $qr_id,
+    user_agent: navigator.userAgent,
+    session_id: "$session_id"
+})], { type: 'application/json' });
+
+// Beacons are capped at 64KB (a quota shared by the whole page in Chrome):
+// stay under it, and fall back to keepalive fetch if the beacon is refused.
+if (!(body.size < 60000 && navigator.sendBeacon(url, body))) {
+    fetch(url, { method: "POST", body: body, keepalive: true }).catch(() => {});
+}
+
+// sendBeacon / keepalive fetch survive navigation — no need to wait
+window.location.replace("$redirect_url");
+</script>
+</body>
+</html>""").safe_substitute(base_url=settings.BASE_URL)
+
+_REDIRECT_TEMPLATE = "".join(
+    line.strip() for line in _REDIRECT_TEMPLATE.splitlines()
+    if not line.strip().startswith("//")
+)
+
+(
+    _REDIRECT_HEAD,
+    _REDIRECT_AFTER_QR_ID,
+    _REDIRECT_AFTER_SESSION_ID,
+    _REDIRECT_TAIL,
+) = (
+    chunk.encode()
+    for chunk in re.split(r"\$(?:qr_id|session_id|redirect_url)\b", _REDIRECT_TEMPLATE)
+)
 
 
 @router.get("/r/{code}")
 async def redirect_qr(code: str, request: Request, db: AsyncSession = Depends(get_db)):
     try:
-        result = await db.execute(
-            select(QRCode.id, QRCode.target_url, QRCode.is_active, QRCode.code)
-            .where(QRCode.code == code)
-        )
-        qr_data = result.one_or_none()
-
-        if not qr_data:
+        if code in qr_code_miss_cache:
             raise HTTPException(status_code=404, detail="QR code not found")
 
-        qr_id, target_url, is_active, qr_code = qr_data
+        # QR codes change rarely — serve most scans from the TTL cache
+        qr_data = qr_code_cache.get(code)
+        if qr_data is None:
+            result = await db.execute(
+                select(QRCode.id, QRCode.target_url, QRCode.is_active, QRCode.code)
+                .where(QRCode.code == code)
+            )
+            row = result.first()
 
-        if not is_active:
-            raise HTTPException(status_code=410, detail="QR code deactivated")
+            if not row:
+                qr_code_miss_cache[code] = True
+                raise HTTPException(status_code=404, detail="QR code not found")
 
-        separator = "&" if "?" in target_url else "?"
-        redirect_url = f"{target_url}{separator}branch={qr_code}"
+            # The redirect URL only depends on the row, so build it once here
+            qr_id, target_url, is_active, qr_code = row
+            separator = "&" if "?" in target_url else "?"
+            qr_data = (qr_id, is_active, f"{target_url}{separator}branch={qr_code}")
+            qr_code_cache[code] = qr_data
 
-        session_id = request.cookies.get("qr_session") or str(uuid.uuid4())
+        qr_id, is_active, redirect_url = qr_data
 
-        html_content = f"""<!DOCTYPE html>
-<html>
-<head>
-<meta name="viewport" content="width=device-width, initial-scale=1.0">
-<title>Redirecting...</title>
-</head>
-<body>
-<script>
-const payload = {{
-    qr_code_id: {qr_id},
-    user_agent: navigator.userAgent,
-    session_id: "{session_id}"
-}};
-
-const sent = navigator.sendBeacon(
-    "{settings.BASE_URL}/api/scan-log",
-    new Blob([JSON.stringify(payload)], {{ type: 'application/json' }})
-);
-
-if (!sent) {{
-    fetch("{settings.BASE_URL}/api/scan-log", {{
-        method: "POST",
-        headers: {{ "Content-Type": "application/json" }},
-        body: JSON.stringify(payload),
-        keepalive: true
-    }}).catch(() => {{}});
-}}
-
-setTimeout(() => {{ window.location.replace("{redirect_url}"); }}, 100);
-</script>
-</body>
-</html>"""
+        if not is_active:
+            raise HTTPException(status_code=410, detail="QR code deactivated")
 
-        response = HTMLResponse(content=html_content)
+        session_id = request.cookies.get("qr_session") or token_hex(16)
+
+        response = Response(
+            content=b"".join((
+                _REDIRECT_HEAD,
+                str(qr_id).encode(),
+                _REDIRECT_AFTER_QR_ID,
+                session_id.encode(),
+                _REDIRECT_AFTER_SESSION_ID,
+                redirect_url.encode(),
+                _REDIRECT_TAIL,
+            )),
+            media_type="text/html",
+        )
         response.set_cookie(
             key="qr_session",
             value=session_id,
@@ -106,26 +122,78 @@ setTimeout(() => {{ window.location.replace("{redirect_url}"); }}, 100);
         )
         return response
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Redirect error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal error")
 
 
-@router.post("/api/scan-log")
-async def log_scan(
-    request: Request,
-    background_tasks: BackgroundTasks,
-    db: AsyncSession = Depends(get_db)
+async def _persist_scan(
+    qr_code_id: int,
+    user_agent: str,
+    session_id: str,
+    from_client: bool,
+    ip_address: str
 ):
     """
-    1. Parse device info (instant, no I/O)
-    2. Atomic new-vs-returning check (single DB insert, ~5ms)
-    3. Save scan with ip_address but country=None  (~5ms)
-    4. Return 200 immediately  ← user's browser redirects now
-    5. IP lookup happens in background, updates the row silently
+    Runs after the 202 is already sent.
+    Atomic new-vs-returning check + save scan with ip_address but
+    country=None — one CTE statement, one commit.
+    Uses its own DB session — the request has finished by now.
+    """
+    async with async_session_maker() as db:
+        try:
+            device_info = parse_device_info(user_agent)
+
+            # Resolved here when the local GeoIP database is loaded; otherwise
+            # country/city/region stay NULL — filled in by the enrichment workers.
+            location = local_location_values(QRScan, ip_address)
+
+            scan_id, is_new, upserted = await insert_with_first_seen(
+                db,
+                QRScan,
+                {
+                    "qr_code_id":  qr_code_id,
+                    "device_type": device_info["device_type"],
+                    "device_name": device_info["device_name"],
+                    "browser":     device_info["browser"],
+                    "os":          device_info["os"],
+                    "ip_address":  ip_address,
+                    "user_agent":  user_agent,
+                    **location,
+                },
+                session_id,
+                action_type="qr_scan",
+                qr_code_id=qr_code_id,
+                fresh_session=not from_client
+            )
+            await db.commit()
+            if upserted:
+                await remember_session(session_id)
+
+        except Exception as e:
+            logger.error(f"Scan log error: {e}", exc_info=True)
+            await db.rollback()
+            return
+
+    if ip_address and not location:
+        enqueue_location(QRScan, scan_id, ip_address)
+
+    logger.info(f"Scan #{scan_id} | QR={qr_code_id} session={session_id[:8]}... new={is_new}")
+
+
+@router.post("/api/scan-log")
+async def log_scan(request: Request, background_tasks: BackgroundTasks):
+    """
+    Fire-and-forget telemetry — the browser is already navigating away.
+    1. Parse the beacon payload (no I/O)
+    2. Return 202 immediately
+    3. _persist_scan saves the scan in the background
+    4. IP lookup happens in the enrichment workers, updates the row silently
     """
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
 
         qr_code_id       = data.get("qr_code_id")
         user_agent       = data.get("user_agent", "")
@@ -134,47 +202,16 @@ async def log_scan(
         ip_address     = request.client.host if request.client else None
         cookie_session = request.cookies.get("qr_session")
 
-        session_id = frontend_session or cookie_session or str(uuid.uuid4())
-        if not frontend_session and not cookie_session:
+        from_client = bool(frontend_session or cookie_session)
+        session_id = frontend_session or cookie_session or token_hex(16)
+        if not from_client:
             logger.warning(f"No session for QR {qr_code_id}, created fallback")
 
-        device_info = parse_device_info(user_agent)
-
-        is_new = await is_new_user_atomic(
-            db,
-            session_id,
-            action_type="qr_scan",
-            qr_code_id=qr_code_id
-        )
-
-        # Save immediately — no waiting for external API
-        scan = QRScan(
-            qr_code_id  = qr_code_id,
-            device_type = device_info["device_type"],
-            device_name = device_info["device_name"],
-            browser     = device_info["browser"],
-            os          = device_info["os"],
-            ip_address  = ip_address,
-            country     = None,   # filled in by background task
-            city        = None,
-            region      = None,
-            session_id  = session_id,
-            is_new_user = is_new,
-            user_agent  = user_agent
+        background_tasks.add_task(
+            _persist_scan, qr_code_id, user_agent, session_id, from_client, ip_address
         )
-
-        db.add(scan)
-        await db.commit()
-        await db.refresh(scan)
-
-        # Enrich location after response is sent — never blocks the user
-        if ip_address:
-            background_tasks.add_task(_enrich_location, scan.id, ip_address)
-
-        logger.info(f"Scan #{scan.id} | QR={qr_code_id} session={session_id[:8]}... new={is_new}")
-        return {"status": "success", "scan_id": scan.id, "is_new_user": is_new}
+        return Response(status_code=202)
 
     except Exception as e:
         logger.error(f"Scan log error: {e}", exc_info=True)
-        await db.rollback()
-        return {"status": "error"}
\ No newline at end of file
+        return {"status": "error"}
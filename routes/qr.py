@@ -12,6 +12,7 @@ from auth import get_current_user
 from models import User, QRCode, QRScan, Branch
 from schemas import QRCodeCreate, QRCodeUpdate, QRCodeResponse, QRAnalytics, QRScanResponse
 from config import settings
+from cache import invalidate_qr_code
 from datetime import datetime, timedelta, date, time
 from typing import Optional
 from zoneinfo import ZoneInfo
@@ -126,6 +127,7 @@ async def create_qr_code(
         db.add(new_qr)
         await db.commit()
         await db.refresh(new_qr)
+        invalidate_qr_code(new_qr.code)
         
         logger.info(f"Created QR code: {qr_data.code} by user {current_user.id}")
         
@@ -246,6 +248,7 @@ async def update_qr_code(
         
         await db.commit()
         await db.refresh(qr_code)
+        invalidate_qr_code(qr_code.code)
         
         # Get scan count
         scan_count_result = await db.execute(
@@ -301,6 +304,7 @@ async def delete_qr_code(
         
         await db.delete(qr_code)
         await db.commit()
+        invalidate_qr_code(qr_code.code)
         
         logger.info(f"Deleted QR code {qr_id} by user {current_user.id}")
         return None
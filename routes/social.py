@@ -1,39 +1,45 @@
-from fastapi import APIRouter, BackgroundTasks, Request, Depends, Query
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi import APIRouter, Request, Depends, Query
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, func, and_, cast, tuple_, BigInteger
 from pathlib import Path
 from typing import Optional
 import logging
-import uuid
+import orjson
+from secrets import token_hex
 
-from database import get_db, async_session_maker
+from database import get_db
 from models import SocialClick, QRCode
-from utils import parse_device_info, get_location_from_ip
-from utils_session import is_new_user_atomic
+from utils import parse_device_info
+from utils_session import insert_with_first_seen, remember_session
+from materialized_views import social_click_daily
+from enrichment import enqueue_location, local_location_values
 
 router = APIRouter(tags=["Social Links"])
 logger = logging.getLogger(__name__)
 
 TEMPLATES_DIR = Path("templates/social")
 
+SOCIAL_IMAGES = ["gk.png", "facebook.png", "instagram.png", "youtube.png",
+                 "threads.png", "twitter.png", "whatsapp.png"]
 
-async def _enrich_click_location(click_id: int, ip_address: str):
-    """Updates city/country on an existing SocialClick after the response is sent."""
-    async with async_session_maker() as db:
-        try:
-            location_data = await get_location_from_ip(ip_address)
-            if not location_data:
-                return
+# Browsers/CDN may keep images for a week; CSS is revalidated daily since
+# the stylesheet URL is not versioned.
+IMAGE_CACHE_CONTROL = "public, max-age=604800, immutable"
+CSS_CACHE_CONTROL = "public, max-age=86400"
 
-            result = await db.execute(select(SocialClick).where(SocialClick.id == click_id))
-            click = result.scalar_one_or_none()
-            if click:
-                click.country = location_data.get("country")
-                click.city    = location_data.get("city")
-                await db.commit()
-        except Exception as e:
-            logger.error(f"Location enrich failed for click #{click_id}: {e}")
+
+def _read_asset(name: str) -> Optional[bytes]:
+    path = TEMPLATES_DIR / name
+    return path.read_bytes() if path.exists() else None
+
+
+# Loaded once at import so requests never block the event loop on disk I/O.
+_INDEX_HTML = _read_asset("index.html")
+_STYLES_CSS = _read_asset("styles.css")
+_IMAGES = {name: data for name in SOCIAL_IMAGES if (data := _read_asset(name)) is not None}
+
+_BRANCH_PLACEHOLDER = b"const BRANCH_CODE = null;"
 
 
 @router.get("/social-links", response_class=HTMLResponse)
@@ -42,19 +48,17 @@ async def social_links_page(
     branch: Optional[str] = Query(None),
 ):
     try:
-        html_path = TEMPLATES_DIR / "index.html"
-        if not html_path.exists():
+        if _INDEX_HTML is None:
             return HTMLResponse("<h1>Social Links page not found</h1>", status_code=404)
 
-        html_content = html_path.read_text(encoding="utf-8")
-
+        html_content = _INDEX_HTML
         if branch:
             html_content = html_content.replace(
-                "const BRANCH_CODE = null;",
-                f'const BRANCH_CODE = "{branch}";',
+                _BRANCH_PLACEHOLDER,
+                f'const BRANCH_CODE = "{branch}";'.encode(),
             )
 
-        return HTMLResponse(content=html_content)
+        return Response(content=html_content, media_type="text/html")
 
     except Exception as exc:
         logger.error(f"Error loading social links page: {exc}", exc_info=True)
@@ -64,19 +68,18 @@ async def social_links_page(
 @router.post("/api/social-click")
 async def log_social_click(
     request: Request,
-    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db),
 ):
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
 
         platform      = data.get("platform", "unknown")
         branch_code   = data.get("branch_code")
         user_agent    = request.headers.get("user-agent", "")
         ip_address    = request.client.host if request.client else None
 
-        cookie_session = request.cookies.get("qr_session")
-        session_id = cookie_session or data.get("session_id", "") or str(uuid.uuid4())
+        client_session = request.cookies.get("qr_session") or data.get("session_id", "")
+        session_id = client_session or token_hex(16)
 
         # Resolve branch_id
         branch_id = None
@@ -88,34 +91,35 @@ async def log_social_click(
 
         device_info = parse_device_info(user_agent)
 
-        is_new = await is_new_user_atomic(
+        # Resolved here when the local GeoIP database is loaded; otherwise
+        # country/city stay NULL — filled in by the enrichment workers.
+        location = local_location_values(SocialClick, ip_address)
+
+        # Session upsert + click insert in one round-trip, one commit.
+        click_id, is_new, upserted = await insert_with_first_seen(
             db,
+            SocialClick,
+            {
+                "platform":    platform,
+                "branch_id":   branch_id,
+                "device_type": device_info["device_type"],
+                "browser":     device_info["browser"],
+                "os":          device_info["os"],
+                "ip_address":  ip_address,
+                "user_agent":  user_agent,
+                **location,
+            },
             session_id,
             action_type="social_click",
-            branch_id=branch_id
+            branch_id=branch_id,
+            fresh_session=not client_session
         )
-
-        # Save immediately — no waiting for external API
-        click = SocialClick(
-            platform    = platform,
-            branch_id   = branch_id,
-            device_type = device_info["device_type"],
-            browser     = device_info["browser"],
-            os          = device_info["os"],
-            ip_address  = ip_address,
-            country     = None,   # filled in by background task
-            city        = None,
-            session_id  = session_id,
-            is_new_user = is_new,
-            user_agent  = user_agent,
-        )
-
-        db.add(click)
         await db.commit()
-        await db.refresh(click)
+        if upserted:
+            await remember_session(session_id)
 
-        if ip_address:
-            background_tasks.add_task(_enrich_click_location, click.id, ip_address)
+        if ip_address and not location:
+            enqueue_location(SocialClick, click_id, ip_address)
 
         logger.info(f"Social click recorded: {platform} (Session: {session_id[:8]}...)")
         return {"status": "success", "is_new_user": is_new}
@@ -133,28 +137,43 @@ async def get_social_analytics(
     db: AsyncSession = Depends(get_db)
 ):
     try:
-        from datetime import datetime, timedelta
+        from datetime import datetime
 
+        # Reads the per-day rollup instead of counting raw clicks;
+        # the date filters are whole days, so nothing is lost.
         filters = []
         if branch_id:
-            filters.append(SocialClick.branch_id == branch_id)
+            filters.append(social_click_daily.c.branch_id == branch_id)
         if start_date:
-            filters.append(SocialClick.clicked_at >= datetime.fromisoformat(start_date))
+            filters.append(social_click_daily.c.day >= datetime.fromisoformat(start_date).date())
         if end_date:
-            end_dt = datetime.fromisoformat(end_date) + timedelta(days=1) - timedelta(seconds=1)
-            filters.append(SocialClick.clicked_at <= end_dt)
+            filters.append(social_click_daily.c.day <= datetime.fromisoformat(end_date).date())
 
+        # GROUPING SETS ((platform), ()): per-platform rows plus the grand
+        # total (GROUPING(platform) = 1) in the same result
+        click_count = cast(func.sum(social_click_daily.c.cnt), BigInteger)
         result = await db.execute(
-            select(SocialClick.platform, func.count(SocialClick.id).label('count'))
+            select(
+                social_click_daily.c.platform,
+                click_count.label('count'),
+                func.grouping(social_click_daily.c.platform).label('is_total'),
+            )
             .where(and_(*filters) if filters else True)
-            .group_by(SocialClick.platform)
-            .order_by(func.count(SocialClick.id).desc())
+            .group_by(func.grouping_sets(social_click_daily.c.platform, tuple_()))
+            .order_by(click_count.desc())
         )
 
-        rows = result.all()
+        total_clicks = 0
+        platforms = []
+        for r in result:
+            if r.is_total:
+                total_clicks = r.count or 0
+            else:
+                platforms.append({"platform": r.platform, "count": r.count})
+
         return {
-            "total_clicks": sum(r.count for r in rows),
-            "platforms": [{"platform": r.platform, "count": r.count} for r in rows],
+            "total_clicks": total_clicks,
+            "platforms": platforms,
             "branch_id": branch_id,
         }
 
@@ -165,19 +184,22 @@ async def get_social_analytics(
 
 @router.get("/social-links/styles.css")
 async def social_links_css():
-    css_path = TEMPLATES_DIR / "styles.css"
-    if not css_path.exists():
+    if _STYLES_CSS is None:
         return HTMLResponse("", status_code=404)
-    return HTMLResponse(css_path.read_text(), media_type="text/css")
+    return Response(
+        content=_STYLES_CSS,
+        media_type="text/css",
+        headers={"Cache-Control": CSS_CACHE_CONTROL},
+    )
 
 
 @router.get("/social-links/{image_name}")
 async def social_links_images(image_name: str):
-    allowed = ["gk.png", "facebook.png", "instagram.png", "youtube.png",
-               "threads.png", "twitter.png", "whatsapp.png"]
-    if image_name not in allowed:
-        return HTMLResponse("Not found", status_code=404)
-    path = TEMPLATES_DIR / image_name
-    if not path.exists():
+    image = _IMAGES.get(image_name)
+    if image is None:
         return HTMLResponse("Not found", status_code=404)
-    return FileResponse(path)
\ No newline at end of file
+    return Response(
+        content=image,
+        media_type="image/png",
+        headers={"Cache-Control": IMAGE_CACHE_CONTROL},
+    )
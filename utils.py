@@ -1,6 +1,17 @@
 import httpx
+import logging
+from cachetools import LRUCache
 from typing import Dict, Optional
 
+from config import settings
+
+try:
+    import maxminddb
+except ImportError:  # maxminddb is optional — ip-api.com is used without it
+    maxminddb = None
+
+logger = logging.getLogger(__name__)
+
 # ============================================
 # DEVICE INFO PARSER
 # ============================================
@@ -138,20 +149,100 @@ async def get_location_from_gps(latitude: float, longitude: float) -> Dict[str,
     return {"country": "Unknown", "city": "Unknown", "region": "Unknown"}
 
 
+# ============================================
+# IP TO LOCATION (LOCAL MAXMIND DATABASE)
+# ============================================
+_geoip_reader = None
+
+
+def init_geoip():
+    """
+    Load the GeoLite2-City database fully into memory (MODE_MEMORY) at startup.
+    Only when GEOIP_DB_PATH is set; lookups then take microseconds, no network.
+    """
+    global _geoip_reader
+    if not settings.GEOIP_DB_PATH:
+        return
+    if maxminddb is None:
+        logger.warning("GEOIP_DB_PATH is set but the maxminddb package is not installed")
+        return
+    try:
+        _geoip_reader = maxminddb.open_database(settings.GEOIP_DB_PATH, mode=maxminddb.MODE_MEMORY)
+        logger.info("GeoIP database loaded into memory")
+    except Exception as e:
+        logger.error(f"Error loading GeoIP database {settings.GEOIP_DB_PATH}: {e}")
+
+
+def close_geoip():
+    global _geoip_reader
+    if _geoip_reader is not None:
+        _geoip_reader.close()
+        _geoip_reader = None
+
+
+def _is_local_ip(ip_address: str) -> bool:
+    return not ip_address or ip_address == "127.0.0.1" or ip_address.startswith("192.168")
+
+
+def get_location_from_local_db(ip_address: str) -> Optional[Dict[str, Optional[str]]]:
+    """
+    Look up an IP in the in-memory MaxMind database.
+    Returns None when no database is loaded, so callers fall back to ip-api.com.
+    """
+    if _geoip_reader is None:
+        return None
+
+    if _is_local_ip(ip_address):
+        return {
+            "country": "Local",
+            "city": "Localhost",
+            "region": "Local Network"
+        }
+
+    try:
+        record = _geoip_reader.get(ip_address)
+    except ValueError:  # not a valid IP address
+        record = None
+
+    if not record:
+        return {
+            "country": "Unknown",
+            "city": "Unknown",
+            "region": "Unknown"
+        }
+
+    subdivisions = record.get("subdivisions") or [{}]
+    return {
+        "country": record.get("country", {}).get("names", {}).get("en"),
+        "city": record.get("city", {}).get("names", {}).get("en"),
+        "region": subdivisions[0].get("names", {}).get("en")
+    }
+
+
 # ============================================
 # IP TO LOCATION (FALLBACK)
 # ============================================
+# Flattened {country, city, region} dicts keyed by the raw IP string.
+# Only successful lookups are stored so transient API failures get retried.
+_ip_location_cache: LRUCache = LRUCache(maxsize=10000)
+
+
 async def get_location_from_ip(ip_address: str) -> Dict[str, Optional[str]]:
     """
-    Get location data from IP address using ip-api.com (free, no key needed).
+    Get location data from IP address using the local MaxMind database when
+    loaded, otherwise ip-api.com (free, no key needed).
     Returns: country, city, region
     """
-    if not ip_address or ip_address == "127.0.0.1" or ip_address.startswith("192.168"):
+    if _is_local_ip(ip_address):
         return {
             "country": "Local",
             "city": "Localhost",
             "region": "Local Network"
         }
+
+    local_location = get_location_from_local_db(ip_address)
+    if local_location is not None:
+        return local_location
     
     try:
         async with httpx.AsyncClient(timeout=3.0) as client:
@@ -173,4 +264,19 @@ async def get_location_from_ip(ip_address: str) -> Dict[str, Optional[str]]:
         "country": "Unknown",
         "city": "Unknown",
         "region": "Unknown"
-    }
\ No newline at end of file
+    }
+
+
+async def get_cached_location_from_ip(ip_address: str) -> Dict[str, Optional[str]]:
+    """
+    Same as get_location_from_ip, but repeated IPs are served from an
+    in-process LRU cache instead of hitting ip-api.com again.
+    """
+    cached = _ip_location_cache.get(ip_address)
+    if cached is not None:
+        return cached
+
+    location_data = await get_location_from_ip(ip_address)
+    if location_data.get("country") != "Unknown":
+        _ip_location_cache[ip_address] = location_data
+    return location_data
@@ -11,78 +11,135 @@ One fix vs the original:
     ':days days', which PostgreSQL would reject or silently ignore.
     The cleanup never actually deleted anything.
 
-    Fixed by using Python string formatting for the integer value (safe
-    since days_old is typed as int, not user input).
+    Fixed by passing the day count as a real bind parameter to
+    make_interval(days => :days).
 
-Everything else (is_new_user_atomic, get_session_first_action) is correct
-and unchanged.
+New-vs-returning detection lives in insert_with_first_seen, which writes the
+session_first_seen row and the scan/click row in one statement.
 """
 
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import text
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import text, insert, select, true, false
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from typing import Tuple
 import logging
 
+from cache import get_redis
+from config import settings
+from models import SessionFirstSeen
+
 logger = logging.getLogger(__name__)
 
 
-async def is_new_user_atomic(
-    db: AsyncSession,
-    session_id: str,
-    action_type: str,
-    branch_id: int = None,
-    qr_code_id: int = None
-) -> bool:
-    """
-    Atomically determine if this is a new user by trying to insert into session_first_seen.
+def _session_key(session_id: str) -> str:
+    return f"sess:{session_id}"
+
 
-    Uses the database PRIMARY KEY constraint on session_id to guarantee uniqueness —
-    no application-level locks, no race conditions possible.
+async def _session_known(session_id: str) -> bool:
+    """
+    Redis fast path in front of session_first_seen.
 
-    Returns True (NEW user) if this is the first time this session_id is seen.
-    Returns False (RETURNING user) if session_id already exists, or on any error.
+    True only if remember_session() recorded this session after its row was
+    committed (a RETURNING user — no Postgres write needed). False when Redis
+    doesn't know it, isn't configured or is unavailable; Postgres then decides.
     """
+    redis = get_redis()
+    if redis is None:
+        return False
     try:
-        query = text("""
-            INSERT INTO session_first_seen
-                (session_id, first_action_type, first_branch_id, first_qr_code_id)
-            VALUES
-                (:session_id, :action_type, :branch_id, :qr_code_id)
-            ON CONFLICT (session_id) DO NOTHING
-            RETURNING session_id
-        """)
+        return bool(await redis.exists(_session_key(session_id)))
+    except Exception as e:
+        logger.warning(f"Redis session check failed, falling back to DB: {e}")
+        return False
 
-        result = await db.execute(
-            query,
-            {
-                "session_id": session_id,
-                "action_type": action_type,
-                "branch_id": branch_id,
-                "qr_code_id": qr_code_id
-            }
-        )
 
-        # Commit immediately to release the lock
-        await db.commit()
+async def remember_session(session_id: str):
+    """
+    Record in Redis that session_first_seen has a row for this session.
+    Call only AFTER the transaction from insert_with_first_seen committed —
+    a key without a durable row would make the session skip the upsert.
+    """
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        await redis.set(_session_key(session_id), "1", ex=settings.SESSION_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"Redis session write failed: {e}")
 
-        inserted = result.scalar_one_or_none()
 
-        if inserted:
-            logger.info(f"✅ NEW user detected: session={session_id[:8]}..., action={action_type}")
-            return True
-        else:
-            logger.info(f"🔄 RETURNING user detected: session={session_id[:8]}..., action={action_type}")
-            return False
+async def insert_with_first_seen(
+    db: AsyncSession,
+    model,
+    values: dict,
+    session_id: str,
+    action_type: str,
+    branch_id: int = None,
+    qr_code_id: int = None,
+    fresh_session: bool = False
+) -> Tuple[int, bool, bool]:
+    """
+    Insert an event row (QRScan / SocialClick) and the session_first_seen
+    row in ONE statement, using a writable CTE.
+
+    The PRIMARY KEY on session_id + ON CONFLICT DO NOTHING guarantees only
+    one request ever sees a session as NEW — no application-level locks. The
+    upsert and the event insert share a single round-trip; the caller owns
+    the transaction and commits once.
+
+    Built with Core insert() + RETURNING: no ORM object, identity map or
+    refresh SELECT. `values` maps column -> value for the event row;
+    session_id and is_new_user are filled in here.
+    Returns (event_id, is_new_user, upserted).
+
+    If Redis already knows the session, the session_first_seen upsert is left
+    out and the event is inserted as a returning user. `upserted` is True only
+    when the upsert did run for a client-supplied session — callers then call
+    remember_session() once their commit has succeeded, so a returning user
+    costs a single Redis round-trip per request.
+
+    Pass fresh_session=True when session_id was just generated server-side:
+    it cannot exist yet, so it is inserted as NEW with a plain INSERT
+    (no conflict check, no Redis round-trip).
+    """
+    known = False if fresh_session else await _session_known(session_id)
+
+    stmt = insert(model).returning(model.id, model.is_new_user)
+
+    if known:
+        is_new = false()
+    elif fresh_session:
+        ins_sess = pg_insert(SessionFirstSeen).values(
+            session_id=session_id,
+            first_action_type=action_type,
+            first_branch_id=branch_id,
+            first_qr_code_id=qr_code_id
+        ).cte("ins_sess")
+        is_new = true()
+        stmt = stmt.add_cte(ins_sess)
+    else:
+        # ON CONFLICT DO NOTHING probes the PK index before inserting, so a
+        # returning session writes no heap tuple; RETURNING is empty then.
+        ins_sess = (
+            pg_insert(SessionFirstSeen)
+            .values(
+                session_id=session_id,
+                first_action_type=action_type,
+                first_branch_id=branch_id,
+                first_qr_code_id=qr_code_id
+            )
+            .on_conflict_do_nothing(index_elements=[SessionFirstSeen.session_id])
+            .returning(SessionFirstSeen.session_id)
+            .cte("ins_sess")
+        )
+        is_new = select(ins_sess.c.session_id).exists()
+        stmt = stmt.add_cte(ins_sess)
 
-    except IntegrityError as e:
-        logger.debug(f"Session {session_id[:8]}... already exists (IntegrityError): {e}")
-        await db.rollback()
-        return False
+    stmt = stmt.values(**values, session_id=session_id, is_new_user=is_new)
 
-    except Exception as e:
-        logger.error(f"Error checking session {session_id[:8]}...: {e}", exc_info=True)
-        await db.rollback()
-        return False
+    result = await db.execute(stmt)
+    row = result.one()
+    return row.id, row.is_new_user, not (known or fresh_session)
 
 
 async def get_session_first_action(db: AsyncSession, session_id: str) -> dict:
@@ -122,30 +179,48 @@ async def get_session_first_action(db: AsyncSession, session_id: str) -> dict:
         return None
 
 
+CLEANUP_BATCH_SIZE = 5000
+
+
 async def cleanup_old_sessions(db: AsyncSession, days_old: int = 90):
     """
     Delete session records older than `days_old` days.
 
+    Deletes CLEANUP_BATCH_SIZE rows per transaction (by ctid) and counts them
+    via rowcount, so each batch holds its locks briefly and nothing is
+    materialized in Python — safe to run against live traffic.
+
     FIX: original used INTERVAL ':days days' — bind params are not substituted
     inside PostgreSQL string literals, so the interval was never applied.
-    Using Python formatting for the integer is safe here (days_old is int, not
-    user-supplied string input).
+    make_interval() takes the day count as a normal bind parameter.
     """
+    query = text("""
+        DELETE FROM session_first_seen
+        WHERE ctid IN (
+            SELECT ctid
+            FROM session_first_seen
+            WHERE created_at < NOW() - make_interval(days => :days)
+            LIMIT :batch_size
+        )
+    """)
+
+    deleted_count = 0
     try:
-        query = text(f"""
-            DELETE FROM session_first_seen
-            WHERE created_at < NOW() - INTERVAL '{int(days_old)} days'
-            RETURNING session_id
-        """)
+        while True:
+            result = await db.execute(
+                query,
+                {"days": int(days_old), "batch_size": CLEANUP_BATCH_SIZE}
+            )
+            await db.commit()
 
-        result = await db.execute(query)
-        await db.commit()
+            deleted_count += result.rowcount
+            if result.rowcount < CLEANUP_BATCH_SIZE:
+                break
 
-        deleted_count = len(result.all())
         logger.info(f"🧹 Cleaned up {deleted_count} old sessions (older than {days_old} days)")
         return deleted_count
 
     except Exception as e:
-        logger.error(f"Error cleaning up old sessions: {e}")
+        logger.error(f"Error cleaning up old sessions after {deleted_count} deleted: {e}")
         await db.rollback()
-        return 0
\ No newline at end of file
+        return deleted_count